@@ -1,26 +1,34 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 from datetime import datetime
 from io import BytesIO
-import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 import gspread
-from gspread_dataframe import set_with_dataframe
-import xlsxwriter
 
 # --- CONFIGURAÇÃO INICIAL E CONEXÃO COM GOOGLE SHEETS ---
 
 # Define a configuração da página
 st.set_page_config(page_title="Avaliação Qualitativa", layout="wide")
 
-# Conecta ao Google Sheets usando as credenciais armazenadas nos Secrets do Streamlit
-try:
+@st.cache_resource
+def get_sheets():
+    """
+    Conecta ao Google Sheets usando as credenciais armazenadas nos Secrets do Streamlit e abre as abas usadas.
+    Fica em cache_resource: a autenticação acontece uma vez por processo do servidor, não a cada rerun.
+    """
     gc = gspread.service_account_from_dict(st.secrets["gcp_service_account"])
     # Substitua 'Dados_Escola' pelo nome exato da sua Planilha Google
     spreadsheet = gc.open("Dados_Escola")
-    ws_disciplinas = spreadsheet.worksheet("Disciplinas")
-    ws_turmas = spreadsheet.worksheet("Turmas")
-    ws_alunos = spreadsheet.worksheet("Alunos")
-    ws_notas = spreadsheet.worksheet("Notas")
+    return (
+        spreadsheet.worksheet("Disciplinas"),
+        spreadsheet.worksheet("Turmas"),
+        spreadsheet.worksheet("Alunos"),
+        spreadsheet.worksheet("Notas"),
+    )
+
+try:
+    ws_disciplinas, ws_turmas, ws_alunos, ws_notas = get_sheets()
     st.session_state['db_connection'] = True
 except Exception as e:
     st.error("Não foi possível conectar à base de dados (Google Sheets). Verifique as configurações de 'Secrets'.")
@@ -31,58 +39,290 @@ except Exception as e:
 
 # --- FUNÇÕES DE AUXÍLIO E DADOS ---
 
-def remover_acentos(texto):
+def remover_acentos_series(s):
     """
-    Remove acentos de uma string, normalizando-a para a ordenação.
+    Remove acentos de uma Series de strings de uma só vez, normalizando-a para a ordenação.
     """
-    nfkd_form = unicodedata.normalize('NFKD', str(texto))
-    return u"".join([c for c in nfkd_form if not unicodedata.combining(c)])
+    return s.astype(str).str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('ascii')
+
+def ordenar_opcoes(s):
+    """
+    Retorna os valores não vazios de uma coluna em ordem alfabética, ignorando acentos e maiúsculas,
+    para uso direto nas caixas de seleção.
+    """
+    s = s.dropna().astype(str)
+    s = s[s.str.strip() != ""]
+    return s.sort_values(key=lambda col: remover_acentos_series(col).str.lower()).tolist()
+
+
+def ler_abas(worksheets):
+    """
+    Lê várias abas da Planilha Google com uma única chamada (values.batchGet)
+    e devolve um DataFrame por aba, usando a primeira linha como cabeçalho.
+    """
+    resposta = worksheets[0].spreadsheet.values_batch_get([f"'{ws.title}'!A:Z" for ws in worksheets])
+    dfs = []
+    for value_range in resposta.get("valueRanges", []):
+        linhas = value_range.get("values", [])
+        if not linhas:
+            dfs.append(pd.DataFrame())
+            continue
+        cabecalho = linhas[0]
+        # A API omite as células vazias no fim de cada linha; completa com "" como o get_all_records.
+        corpo = [linha[:len(cabecalho)] + [""] * (len(cabecalho) - len(linha)) for linha in linhas[1:]]
+        dfs.append(pd.DataFrame(corpo, columns=cabecalho))
+    return dfs
 
 @st.cache_data(ttl=60)
-def load_base():
+def load_base(_ws_disciplinas, _ws_turmas, _ws_alunos):
     """ Carrega as abas Disciplinas, Turmas e Alunos da Planilha Google. """
     try:
-        disciplinas_df = pd.DataFrame(ws_disciplinas.get_all_records())
-        turmas_df = pd.DataFrame(ws_turmas.get_all_records())
-        alunos_df = pd.DataFrame(ws_alunos.get_all_records())
+        disciplinas_df, turmas_df, alunos_df = ler_abas([_ws_disciplinas, _ws_turmas, _ws_alunos])
         
-        disciplinas = disciplinas_df["Disciplina"].dropna().astype(str).tolist() if "Disciplina" in disciplinas_df else []
-        turmas = turmas_df["Turma"].dropna().astype(str).tolist() if "Turma" in turmas_df else []
+        disciplinas = ordenar_opcoes(disciplinas_df["Disciplina"]) if "Disciplina" in disciplinas_df else []
+        turmas = ordenar_opcoes(turmas_df["Turma"]) if "Turma" in turmas_df else []
+        # Chave de ordenação sem acentos e sem distinção de maiúsculas, calculada uma única vez por carga da base
+        alunos_df["_sort_key"] = remover_acentos_series(alunos_df["Aluno"]).str.lower()
+        # Nomes dos alunos de cada turma, já ordenados, para o editor consultar sem filtrar a tabela
+        alunos_por_turma = {
+            t: sub["Aluno"].to_numpy()
+            for t, sub in alunos_df.sort_values("_sort_key").groupby("Turma", sort=False)
+        }
         
-        return disciplinas, turmas, alunos_df
+        return disciplinas, turmas, alunos_df, alunos_por_turma
     except Exception as e:
         st.error(f"Erro ao carregar a base de dados: {e}")
-        return [], [], pd.DataFrame(columns=["Turma", "Aluno"])
+        return [], [], pd.DataFrame(columns=["Turma", "Aluno", "_sort_key"]), {}
+
+
+def preparar_notas(notas_df):
+    """
+    Converte as colunas de texto repetitivo em `category` e indexa as notas por (Trimestre, Disciplina, Turma),
+    para que os filtros da tela sejam buscas no índice em vez de comparações de strings na tabela inteira.
+    """
+    notas_df = notas_df.astype({"Trimestre": "category", "Disciplina": "category", "Turma": "category", "Aluno": "category", "Nota": "float64"})
+    return notas_df.set_index(["Trimestre", "Disciplina", "Turma"]).sort_index()
+
+
+def fatia_notas(notas_df, chave):
+    """
+    Retorna as notas de um trimestre (`chave` = trimestre) ou de um trimestre, disciplina e turma
+    (`chave` = tupla com os três), buscando no índice ordenado. Vazio se não houver lançamentos.
+    """
+    try:
+        return notas_df.loc[[chave]]
+    except KeyError:
+        return notas_df.iloc[0:0]
+
+
+def ler_notas(ws):
+    """ Lê todas as notas da Planilha Google. Erros de leitura são propagados para quem chamou. """
+    notas_df, = ler_abas([ws])
+    if notas_df.empty:
+        return preparar_notas(pd.DataFrame(columns=["Trimestre", "Disciplina", "Turma", "Aluno", "Nota", "Timestamp"]))
+    
+    # Garante que a coluna 'Nota' está no formato numérico correto para o cálculo.
+    if 'Nota' in notas_df.columns:
+        # Substitui a vírgula decimal e converte para numérico de uma só vez, tratando valores inválidos
+        notas_df['Nota'] = pd.to_numeric(notas_df['Nota'].str.replace(',', '.', regex=False), errors='coerce')
+        
+    return preparar_notas(notas_df)
 
 
 @st.cache_data(ttl=30)
-def load_notas():
+def load_notas(_ws_notas):
     """ Carrega todas as notas da Planilha Google. """
     try:
-        notas_df = pd.DataFrame(ws_notas.get_all_records())
-        if notas_df.empty:
-            return pd.DataFrame(columns=["Trimestre", "Disciplina", "Turma", "Aluno", "Nota", "Timestamp"])
-        
-        # Garante que a coluna 'Nota' está no formato numérico correto para o cálculo.
-        if 'Nota' in notas_df.columns:
-            # Converte para string para garantir a substituição da vírgula
-            notas_df['Nota'] = notas_df['Nota'].astype(str).str.replace(',', '.', regex=False)
-            # Converte para numérico, tratando erros para valores inválidos
-            notas_df['Nota'] = pd.to_numeric(notas_df['Nota'], errors='coerce')
-            
-        return notas_df
+        return ler_notas(_ws_notas)
     except Exception as e:
         st.error(f"Erro ao carregar as notas: {e}")
-        return pd.DataFrame(columns=["Trimestre", "Disciplina", "Turma", "Aluno", "Nota", "Timestamp"])
+        return preparar_notas(pd.DataFrame(columns=["Trimestre", "Disciplina", "Turma", "Aluno", "Nota", "Timestamp"]))
+
+
+def montar_relatorio(agg, alunos_df, trimestre):
+    """
+    Junta as médias por aluno (`agg`, indexado por Aluno) aos alunos de `alunos_df`, ordenando por turma e nome.
+    Alunos sem lançamentos aparecem com média vazia e 0 lançamentos.
+    """
+    df_result = alunos_df[['Turma', 'Aluno', '_sort_key']].merge(agg, left_on='Aluno', right_index=True, how='left')
+    df_result['Média Qualitativa'] = df_result['Média Qualitativa'].round(1)
+    df_result['Lançamentos'] = df_result['Lançamentos'].fillna(0).astype(int)
+    df_result.insert(0, 'Trimestre', trimestre)
+    # Ordena por turma e nome sem acentos usando a chave já calculada em load_base
+    ordem = np.lexsort((df_result['_sort_key'].to_numpy(), df_result['Turma'].to_numpy()))
+    return df_result.iloc[ordem].drop(columns='_sort_key').reset_index(drop=True)
+
+
+def calcular_medias(notas_df, alunos_df, trimestre):
+    """
+    Calcula, para cada aluno de `alunos_df`, a média das últimas notas lançadas em cada disciplina no trimestre.
+    """
+    notas_tri = fatia_notas(notas_df, trimestre).reset_index().sort_values('Timestamp')
+    ultimas = notas_tri.drop_duplicates(['Aluno', 'Disciplina'], keep='last')
+    agg = ultimas.groupby('Aluno', sort=False, observed=True)['Nota'].agg(**{'Média Qualitativa': 'mean', 'Lançamentos': 'count'})
+    return montar_relatorio(agg, alunos_df, trimestre)
+
+
+def calcular_medias_todos(notas_df, alunos_df, trimestres):
+    """
+    Calcula o relatório geral de cada trimestre em `trimestres` com uma única passada pelas notas.
+    Retorna um dicionário {trimestre: DataFrame}.
+    """
+    ultimas = notas_df.reset_index().sort_values('Timestamp').drop_duplicates(['Trimestre', 'Aluno', 'Disciplina'], keep='last')
+    agg = ultimas.groupby(['Trimestre', 'Aluno'], observed=True)['Nota'].agg(**{'Média Qualitativa': 'mean', 'Lançamentos': 'count'})
+    por_trimestre = {tri: sub.droplevel('Trimestre') for tri, sub in agg.groupby(level='Trimestre', observed=True)}
+    vazio = agg.iloc[0:0].droplevel('Trimestre')
+    return {tri: montar_relatorio(por_trimestre.get(tri, vazio), alunos_df, tri) for tri in trimestres}
+
+
+def versao_dados(notas_df, alunos_df):
+    """ Identificador barato do estado atual dos dados, usado como chave do cache dos relatórios. """
+    ultimo = str(notas_df['Timestamp'].max()) if not notas_df.empty else ""
+    # Hash do conteúdo da lista de alunos: renomear ou trocar um aluno de turma também invalida os relatórios
+    hash_alunos = int(pd.util.hash_pandas_object(alunos_df[['Turma', 'Aluno']], index=False).sum())
+    return (len(notas_df), ultimo, hash_alunos)
+
+
+def gerar_excel(planilhas):
+    """
+    Gera um arquivo .xlsx com uma aba por item de `planilhas` ({nome da aba: DataFrame}) em modo constant_memory
+    do xlsxwriter, que grava linha a linha e descarta cada linha já escrita.
+    O df.to_excel do pandas escreve coluna a coluna e não funciona nesse modo.
+    """
+    # Importado aqui: só é necessário ao gerar relatórios, não a cada rerun do script
+    import xlsxwriter
+
+    output_excel = BytesIO()
+    workbook = xlsxwriter.Workbook(output_excel, {'constant_memory': True})
+    for sheet_name, df in planilhas.items():
+        worksheet = workbook.add_worksheet(sheet_name)
+        worksheet.write_row(0, 0, df.columns.tolist())
+        # Valores ausentes viram células vazias (o Excel não aceita NaN)
+        for i, linha in enumerate(df.astype(object).where(df.notna(), None).itertuples(index=False), start=1):
+            worksheet.write_row(i, 0, linha)
+    workbook.close()
+    return output_excel.getvalue()
+
+
+@st.cache_data(ttl=60)
+def build_report(trimestre, turma, versao, _notas_df, _alunos_df):
+    """
+    Gera o relatório de médias do trimestre (de uma turma, ou geral se `turma` for None) e o arquivo Excel correspondente.
+    `versao` entra na chave do cache; os DataFrames (prefixados com _) não são hasheados.
+    """
+    if turma is None:
+        alunos = _alunos_df
+        sheet_name = f'Medias_Gerais_{trimestre}'
+    else:
+        alunos = _alunos_df[_alunos_df['Turma'] == turma]
+        sheet_name = f'Medias_{turma}'
+    df_medias = calcular_medias(_notas_df, alunos, trimestre)
+    return df_medias, gerar_excel({sheet_name: df_medias})
+
+
+@st.cache_data(ttl=60)
+def build_report_todos(trimestres, versao, _notas_df, _alunos_df):
+    """ Gera os relatórios gerais de todos os trimestres e um único arquivo Excel com uma aba por trimestre. """
+    relatorios = calcular_medias_todos(_notas_df, _alunos_df, trimestres)
+    return relatorios, gerar_excel({f'Medias_Gerais_{tri}': df for tri, df in relatorios.items()})
 
 
 def save_notas(df_final):
-    """ Salva o DataFrame completo de notas na Planilha Google. """
+    """
+    Salva o DataFrame completo de notas na Planilha Google com uma única gravação (values.update).
+    As linhas que sobram abaixo dos dados, até o tamanho atual da aba, são sobrescritas com células vazias
+    na mesma chamada, seja qual for a sessão (ou pessoa) que as deixou lá.
+    Roda na thread de gravação (ver salvar_notas_em_segundo_plano); erros são propagados para o Future.
+    """
+    df_final = df_final.reset_index()
+    valores = [df_final.columns.tolist()] + df_final.astype(object).where(df_final.notna(), "").values.tolist()
+    # Tamanho real da aba agora (uma leitura de metadados), não o que esta sessão acha que a planilha tem
+    total_linhas = ws_notas.spreadsheet.worksheet(ws_notas.title).row_count
+    valores += [[""] * len(df_final.columns)] * max(total_linhas - len(valores), 0)
+    ws_notas.spreadsheet.values_update(
+        f"'{ws_notas.title}'!A1",
+        params={"valueInputOption": "RAW"},
+        body={"values": valores},
+    )
+
+
+@st.cache_resource
+def get_executor():
+    """
+    Thread única, compartilhada pelo processo, que grava as notas na Planilha Google.
+    Com um só worker as gravações são aplicadas na ordem em que foram enviadas.
+    """
+    return ThreadPoolExecutor(max_workers=1)
+
+
+def salvar_notas_em_segundo_plano(df_final, mensagem):
+    """
+    Atualiza as notas da sessão imediatamente e envia a gravação na planilha para a thread de gravação,
+    sem bloquear o rerun. O resultado é acompanhado por verificar_salvamentos.
+    """
+    futuro = get_executor().submit(save_notas, df_final)
+    # Só invalida o cache das notas quando a planilha já foi atualizada; a base (disciplinas, turmas, alunos) não mudou
+    futuro.add_done_callback(lambda _: load_notas.clear())
+    st.session_state['notas_df_geral'] = df_final # Atualiza o estado da sessão com os novos dados
+    st.session_state.setdefault('salvamentos', []).append((futuro, mensagem))
+
+
+def registrar_falha_salvamento(erro, mensagem):
+    """
+    Trata uma gravação que falhou. Só substitui as notas da sessão se a releitura da planilha funcionar;
+    caso contrário (ex.: a mesma falta de cota ou rede que derrubou a gravação) mantém as alterações
+    na sessão e permite tentar gravar de novo.
+    """
     try:
-        ws_notas.clear()
-        set_with_dataframe(ws_notas, df_final, include_column_header=True)
-    except Exception as e:
-        st.error(f"Erro ao salvar as notas: {e}")
+        st.session_state['notas_df_geral'] = ler_notas(ws_notas)
+    except Exception:
+        st.session_state['falha_salvamento'] = {
+            'texto': f"Erro ao salvar as notas: {erro}. As alterações continuam nesta sessão, mas ainda não estão na planilha.",
+            'mensagem': mensagem,
+            'repetir': True,
+        }
+        return
+    st.session_state['falha_salvamento'] = {
+        'texto': f"Erro ao salvar as notas: {erro}. As notas foram recarregadas da planilha; refaça os lançamentos.",
+        'mensagem': mensagem,
+        'repetir': False,
+    }
+
+
+@st.fragment(run_every=2)
+def verificar_salvamentos():
+    """
+    Acompanha as gravações em segundo plano da sessão. Como fragmento com run_every, roda sozinho a cada 2s
+    enquanto houver gravações pendentes ou uma falha a exibir, sem esperar outra interação do usuário.
+    """
+    salvamentos = st.session_state.get('salvamentos', [])
+    if salvamentos and all(futuro.done() for futuro, _ in salvamentos):
+        # Cada gravação leva a tabela inteira da sessão, então o resultado é o da última enviada:
+        # se ela funcionou, a planilha já tem também o que as anteriores (mesmo as que falharam) tentaram gravar.
+        ultimo, mensagem = salvamentos[-1]
+        st.session_state['salvamentos'] = []
+        if ultimo.exception() is None:
+            st.session_state.pop('falha_salvamento', None)
+            st.session_state['avisos_salvamento'] = [m for _, m in salvamentos]
+        else:
+            registrar_falha_salvamento(ultimo.exception(), mensagem)
+        # Redesenha a página inteira: as notas podem ter sido recarregadas e, sem nada pendente, o fragmento para de rodar
+        st.rerun()
+
+    if salvamentos:
+        st.caption("Salvando alterações na planilha em segundo plano...")
+
+    falha = st.session_state.get('falha_salvamento')
+    if falha:
+        st.error(falha['texto'])
+        if falha['repetir']:
+            if st.button("Tentar salvar novamente", key="retry_save_btn"):
+                del st.session_state['falha_salvamento']
+                salvar_notas_em_segundo_plano(st.session_state['notas_df_geral'], falha['mensagem'])
+                st.rerun(scope="fragment")
+        elif st.button("Fechar", key="dismiss_save_error_btn"):
+            del st.session_state['falha_salvamento']
+            st.rerun()
 
 
 # --- INTERFACE DO STREAMLIT ---
@@ -91,15 +331,20 @@ st.title("📊 Sistema de Avaliação Qualitativa")
 st.write("Sistema centralizado para lançamento de notas qualitativas.")
 
 # 1. Carregar os dados base e notas no estado da sessão apenas uma vez
-if 'disciplinas' not in st.session_state:
-    st.session_state['disciplinas'], st.session_state['turmas'], st.session_state['alunos_df'] = load_base()
+if 'alunos_por_turma' not in st.session_state:
+    st.session_state['disciplinas'], st.session_state['turmas'], st.session_state['alunos_df'], st.session_state['alunos_por_turma'] = load_base(ws_disciplinas, ws_turmas, ws_alunos)
 if 'notas_df_geral' not in st.session_state:
-    st.session_state['notas_df_geral'] = load_notas()
+    st.session_state['notas_df_geral'] = load_notas(ws_notas)
 
 # Se a conexão falhou, o script para no bloco try/except lá em cima.
 if not st.session_state['db_connection']:
     st.stop()
 
+for aviso in st.session_state.pop('avisos_salvamento', []):
+    st.toast(aviso)
+if st.session_state.get('salvamentos') or 'falha_salvamento' in st.session_state:
+    verificar_salvamentos()
+
 
 # --- BARRA LATERAL COM FILTROS ---
 st.sidebar.header("Filtros de Seleção")
@@ -115,17 +360,14 @@ st.subheader(f"_{trimestre} — {disciplina} — {turma}_")
 st.info("Clique na célula de nota para editar. Use Enter ou as setas do teclado para navegar.")
 
 # 1. Preparar os dados para o editor
-alunos_turma_df = st.session_state['alunos_df'][st.session_state['alunos_df']["Turma"] == turma][["Aluno"]].copy()
-alunos_turma_df.sort_values(by="Aluno", key=lambda col: col.str.normalize('NFKD').str.encode('ascii', errors='ignore').str.decode('utf-8'), inplace=True)
+alunos_turma_df = pd.DataFrame({"Aluno": st.session_state['alunos_por_turma'].get(turma, np.array([], dtype=object))})
 
 # Filtra as notas apenas para a visualização atual
-notas_atuais = st.session_state['notas_df_geral'][
-    (st.session_state['notas_df_geral']["Trimestre"] == trimestre) &
-    (st.session_state['notas_df_geral']["Disciplina"] == disciplina) &
-    (st.session_state['notas_df_geral']["Turma"] == turma)
-]
+notas_atuais = fatia_notas(st.session_state['notas_df_geral'], (trimestre, disciplina, turma))
+# Mantém só o último lançamento de cada aluno para que o merge não duplique linhas no editor
+notas_atuais = notas_atuais.sort_values("Timestamp").drop_duplicates("Aluno", keep="last")
 
-df_para_editar = pd.merge(alunos_turma_df, notas_atuais[["Aluno", "Nota"]], on="Aluno", how="left")
+df_para_editar = pd.merge(alunos_turma_df, notas_atuais[["Aluno", "Nota"]], on="Aluno", how="left", validate="many_to_one")
 # CORREÇÃO: Converte a coluna 'Nota' para o tipo string antes de passar para o editor.
 df_para_editar['Nota'] = df_para_editar['Nota'].astype(str)
 
@@ -149,113 +391,82 @@ with col_editor:
 st.markdown("---")
 col_a, col_b, col_c, col_d = st.columns(4)
 
-if submitted:
+if submitted and edited_df.equals(df_para_editar):
+    # Nada foi alterado no editor: evita reescrever a planilha inteira à toa
+    st.info("Sem alterações para salvar.")
+elif submitted:
     # A lógica de processamento foi movida para aqui para garantir o formato correto
-    notas_inseridas = edited_df.dropna(subset=['Nota'])
-    rows_to_save = []
-    for _, row in notas_inseridas.iterrows():
-        try:
-            # Limpa e converte a nota para o formato correto
-            nota_limpa = str(row["Nota"]).replace(',', '.')
-            nota_final = float(nota_limpa)
-
-            # Adiciona uma validação extra para garantir que a nota está no intervalo
-            if 0.0 <= nota_final <= 10.0:
-                rows_to_save.append({
-                    "Trimestre": trimestre, "Disciplina": disciplina, "Turma": turma,
-                    "Aluno": row["Aluno"], "Nota": nota_final, "Timestamp": datetime.now().isoformat()
-                })
-            else:
-                st.warning(f"A nota '{nota_final}' para o aluno '{row['Aluno']}' está fora do intervalo (0-10) e não foi salva.")
-
-        except (ValueError, TypeError):
-            st.warning(f"A nota inserida para o aluno '{row['Aluno']}' não é um número válido e não foi salva. Por favor, use um formato como '8.5' ou '8,5'.")
-
-    if rows_to_save:
-        new_df = pd.DataFrame(rows_to_save)
-        
+    notas_inseridas = edited_df.dropna(subset=['Nota']).copy()
+    # Limpa e converte todas as notas para o formato correto de uma só vez
+    notas_texto = notas_inseridas['Nota'].astype(str).str.strip().str.replace(',', '.', regex=False)
+    notas_inseridas['Nota'] = pd.to_numeric(notas_texto, errors='coerce')
+
+    # Células em branco (exibidas como 'nan' no editor) são ignoradas sem aviso
+    invalidas = notas_inseridas['Nota'].isna() & ~notas_texto.str.lower().isin(['', 'nan', 'none'])
+    fora_do_intervalo = notas_inseridas['Nota'].notna() & ~notas_inseridas['Nota'].between(0.0, 10.0)
+    for aluno in notas_inseridas.loc[invalidas, 'Aluno']:
+        st.warning(f"A nota inserida para o aluno '{aluno}' não é um número válido e não foi salva. Por favor, use um formato como '8.5' ou '8,5'.")
+    for aluno, nota in notas_inseridas.loc[fora_do_intervalo, ['Aluno', 'Nota']].itertuples(index=False):
+        st.warning(f"A nota '{nota}' para o aluno '{aluno}' está fora do intervalo (0-10) e não foi salva.")
+
+    new_df = notas_inseridas[notas_inseridas['Nota'].between(0.0, 10.0)].assign(
+        Trimestre=trimestre, Disciplina=disciplina, Turma=turma, Timestamp=datetime.now().isoformat()
+    )[["Trimestre", "Disciplina", "Turma", "Aluno", "Nota", "Timestamp"]]
+
+    if not new_df.empty:
         # Lógica para atualizar a base de dados geral
-        mask = ~(
-            (st.session_state['notas_df_geral']["Trimestre"] == trimestre) &
-            (st.session_state['notas_df_geral']["Disciplina"] == disciplina) &
-            (st.session_state['notas_df_geral']["Turma"] == turma)
-        )
-        df_mantido = st.session_state['notas_df_geral'][mask]
-        df_final = pd.concat([df_mantido, new_df], ignore_index=True)
+        df_mantido = st.session_state['notas_df_geral'].drop(index=[(trimestre, disciplina, turma)], errors='ignore')
+        df_final = preparar_notas(pd.concat([df_mantido.reset_index(), new_df], ignore_index=True))
         
-        save_notas(df_final)
-        st.session_state['notas_df_geral'] = df_final # Atualiza o estado da sessão com os novos dados
-        st.success(f"{len(new_df)} lançamentos salvos/atualizados na base de dados central.")
-        st.cache_data.clear() # Limpa o cache para recarregar os dados na próxima ação
+        salvar_notas_em_segundo_plano(df_final, f"{len(new_df)} lançamentos salvos/atualizados na base de dados central.")
         st.rerun()
 
+with col_a:
+    if st.button("Gerar todos os relatórios", use_container_width=True):
+        st.info("Calculando médias de todos os trimestres...")
+
+        relatorios, xlsx_bytes = build_report_todos(
+            tuple(trimestres),
+            versao_dados(st.session_state['notas_df_geral'], st.session_state['alunos_df']),
+            st.session_state['notas_df_geral'], st.session_state['alunos_df'],
+        )
+
+        st.subheader("Relatórios Gerais de todos os trimestres")
+        for aba, df_tri in zip(st.tabs(list(relatorios)), relatorios.values()):
+            with aba:
+                st.dataframe(df_tri)
+
+        st.download_button("Baixar Todos os Relatórios", data=xlsx_bytes, file_name="relatorios_gerais_todos_trimestres.xlsx")
+
 with col_b:
     if st.button("Relatório (esta turma)", use_container_width=True):
         st.info("Calculando médias para a turma...")
         
-        alunos_list = st.session_state['alunos_df'][st.session_state['alunos_df']['Turma'] == turma]['Aluno'].tolist()
-        medias = []
-        for aluno in sorted(alunos_list, key=remover_acentos):
-            df_al = st.session_state['notas_df_geral'][(st.session_state['notas_df_geral']['Aluno'] == aluno) & (st.session_state['notas_df_geral']['Trimestre'] == trimestre)]
-            if df_al.empty:
-                medias.append({'Trimestre': trimestre, 'Turma': turma, 'Aluno': aluno, 'Média Qualitativa': None, 'Lançamentos': 0})
-                continue
-            
-            latest = df_al.sort_values('Timestamp').groupby('Disciplina', as_index=False).last()
-            notas = pd.to_numeric(latest['Nota'], errors='coerce').dropna().tolist()
-            if notas:
-                media = sum(notas) / len(notas)
-                medias.append({'Trimestre': trimestre, 'Turma': turma, 'Aluno': aluno, 'Média Qualitativa': round(media, 1), 'Lançamentos': len(notas)})
-            else:
-                medias.append({'Trimestre': trimestre, 'Turma': turma, 'Aluno': aluno, 'Média Qualitativa': None, 'Lançamentos': 0})
-
-        df_medias = pd.DataFrame(medias)
+        df_medias, xlsx_bytes = build_report(
+            trimestre, turma,
+            versao_dados(st.session_state['notas_df_geral'], st.session_state['alunos_df']),
+            st.session_state['notas_df_geral'], st.session_state['alunos_df'],
+        )
         st.subheader(f"Relatório da Turma: {turma}")
         st.dataframe(df_medias)
         
-        output_excel = BytesIO()
-        with pd.ExcelWriter(output_excel, engine='xlsxwriter') as writer:
-            df_medias.to_excel(writer, index=False, sheet_name=f'Medias_{turma}')
-        
-        st.download_button("Baixar Relatório da Turma", data=output_excel.getvalue(), file_name=f"relatorio_{turma.replace(' ', '_')}_{trimestre.replace(' ', '_')}.xlsx")
+        st.download_button("Baixar Relatório da Turma", data=xlsx_bytes, file_name=f"relatorio_{turma.replace(' ', '_')}_{trimestre.replace(' ', '_')}.xlsx")
 
 
 with col_c:
     if st.button("Relatório (geral do tri)", use_container_width=True):
         st.info("Calculando médias para todas as turmas...")
         
-        resultados = []
-        for _, row in st.session_state['alunos_df'].iterrows():
-            aluno = row['Aluno']
-            turma_k = row['Turma']
-            
-            df_al = st.session_state['notas_df_geral'][(st.session_state['notas_df_geral']['Aluno'] == aluno) & (st.session_state['notas_df_geral']['Trimestre'] == trimestre)]
-            if df_al.empty:
-                resultados.append({'Trimestre': trimestre, 'Turma': turma_k, 'Aluno': aluno, 'Média Qualitativa': None, 'Lançamentos': 0})
-                continue
-
-            latest = df_al.sort_values('Timestamp').groupby('Disciplina', as_index=False).last()
-            notas = pd.to_numeric(latest['Nota'], errors='coerce').dropna().tolist()
-            if notas:
-                media = sum(notas) / len(notas)
-                resultados.append({'Trimestre': trimestre, 'Turma': turma_k, 'Aluno': aluno, 'Média Qualitativa': round(media,1), 'Lançamentos': len(notas)})
-            else:
-                resultados.append({'Trimestre': trimestre, 'Turma': turma_k, 'Aluno': aluno, 'Média Qualitativa': None, 'Lançamentos': 0})
-        
-        df_result = pd.DataFrame(resultados)
-        
-        if not df_result.empty:
-            df_result['Aluno_sort'] = df_result['Aluno'].apply(remover_acentos)
-            df_result = df_result.sort_values(by=["Turma", "Aluno_sort"]).drop(columns=['Aluno_sort'])
+        df_result, xlsx_bytes = build_report(
+            trimestre, None,
+            versao_dados(st.session_state['notas_df_geral'], st.session_state['alunos_df']),
+            st.session_state['notas_df_geral'], st.session_state['alunos_df'],
+        )
 
         st.subheader(f"Relatório Geral do {trimestre}")
         st.dataframe(df_result)
         
-        output_excel = BytesIO()
-        with pd.ExcelWriter(output_excel, engine='xlsxwriter') as writer:
-            df_result.to_excel(writer, index=False, sheet_name=f'Medias_Gerais_{trimestre}')
-
-        st.download_button("Baixar Relatório Geral", data=output_excel.getvalue(), file_name=f"relatorio_geral_{trimestre.replace(' ', '_')}.xlsx")
+        st.download_button("Baixar Relatório Geral", data=xlsx_bytes, file_name=f"relatorio_geral_{trimestre.replace(' ', '_')}.xlsx")
 
 # --- LÓGICA DE EXCLUSÃO ---
 with col_d:
@@ -264,17 +475,13 @@ with col_d:
         if password == "qualitativa":
             st.warning(f"Confirma a exclusão das notas de **{disciplina}** ({trimestre}) para a turma **{turma}**?")
             if st.button("Confirmar Exclusão", key="confirm_delete_btn"):
-                mask_to_remove = (
-                    (st.session_state['notas_df_geral']['Trimestre'] == trimestre) & 
-                    (st.session_state['notas_df_geral']['Disciplina'] == disciplina) &
-                    (st.session_state['notas_df_geral']['Turma'] == turma)
-                )
-                df_final = st.session_state['notas_df_geral'][~mask_to_remove]
-                save_notas(df_final)
-                st.session_state['notas_df_geral'] = df_final # Atualiza o estado da sessão
-                st.success("Notas excluídas com sucesso.")
-                st.cache_data.clear()
-                st.rerun()
+                if fatia_notas(st.session_state['notas_df_geral'], (trimestre, disciplina, turma)).empty:
+                    # Nada a remover: evita reescrever a planilha inteira à toa
+                    st.info("Não há notas lançadas para esta seleção.")
+                else:
+                    df_final = st.session_state['notas_df_geral'].drop(index=[(trimestre, disciplina, turma)])
+                    salvar_notas_em_segundo_plano(df_final, "Notas excluídas com sucesso.")
+                    st.rerun()
 
 # --- INSTRUÇÕES NA BARRA LATERAL ---
 st.sidebar.markdown("---")
@@ -282,5 +489,5 @@ st.sidebar.info("Como usar:")
 st.sidebar.write("- Edite as abas da planilha `Dados_Escola` para gerenciar Disciplinas, Turmas e Alunos.")
 st.sidebar.write("- Selecione o trimestre, disciplina e turma nos filtros.")
 st.sidebar.write("- Lance as notas na tabela e clique em 'Salvar lançamentos'.")
-st.sidebar.write("- Use a seção de relatórios para gerar médias por turma ou de forma geral.")
+st.sidebar.write("- Use a seção de relatórios para gerar médias por turma, de forma geral ou de todos os trimestres de uma vez.")
 st.sidebar.write("- Para apagar notas, use a opção 'Excluir Notas'.")